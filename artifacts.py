@@ -0,0 +1,158 @@
+import os
+import json
+import time
+import atexit
+import fnmatch
+from collections import OrderedDict
+
+
+# Directory holding all generated artifacts (annotated images, tables, sky maps)
+ARTIFACTS_DIR = "results"
+# On-disk index mapping artifact keys (job/calibration IDs) to their files
+INDEX_FILENAME = "artifact_index.json"
+# Files adopted from a results/ directory written before the store existed: annotated images and
+# stored tables. Working files (downloaded_image.jpg, table_data.*) are overwritten in place and stay out
+ADOPT_PATTERNS = ("*_annotated_*", "table_*")
+ADOPT_EXCLUDE = ("table_data.*",)
+# Budget of the store: least recently used artifacts are deleted beyond these limits
+MAX_BYTES = 500 * 1024 * 1024
+MAX_FILES = 2000
+# Last-use updates from get() are kept in memory and written with the next put()/eviction,
+# or after this many cache hits (and at exit)
+SAVE_EVERY_HITS = 20
+
+
+class artifact_store():
+    def __init__(self, logger, root=ARTIFACTS_DIR, max_bytes=MAX_BYTES, max_files=MAX_FILES):
+        # logger: logger object for logging info and errors
+        # root: directory where artifacts are written and where the index is kept
+        # max_bytes, max_files: size and file-count budget of the store
+        self.logger = logger
+        self.root = root
+        self.max_bytes = max_bytes
+        self.max_files = max_files
+        self.index_path = os.path.join(root, INDEX_FILENAME)
+        # key -> {"path": main file, "files": all files of the artifact, "size": bytes, "last_used": timestamp}
+        # kept ordered from least to most recently used
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+        self.total_files = 0
+        self.unsaved_hits = 0  # get() updates not written to the index yet
+        os.makedirs(root, exist_ok=True)
+        self.load_index()
+        atexit.register(self.flush)
+
+    def load_index(self):
+        if not os.path.exists(self.index_path):
+            # First start with a store: adopt whatever is already lying in the directory once
+            self.adopt_existing_files()
+            return
+        try:
+            with open(self.index_path, 'r') as f:
+                entries = json.load(f)
+        except Exception as e:
+            self.logger.error(f"Failed to load artifact index {self.index_path}: {e}")
+            entries = {}
+        for key, entry in sorted(entries.items(), key=lambda item: item[1].get("last_used", 0)):
+            self.entries[key] = entry
+            self.total_bytes += entry.get("size", 0)
+            self.total_files += len(entry.get("files", []))
+        self.logger.info(f"Artifact store loaded: {len(self.entries)} artifacts, {self.total_files} files, {self.total_bytes} bytes")
+        self.evict()
+
+    def save_index(self):
+        # Write to a temporary file first so a crash never leaves a truncated index behind
+        tmp_path = self.index_path + ".tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(self.entries, f)
+        os.replace(tmp_path, self.index_path)
+        self.unsaved_hits = 0
+
+    def flush(self):
+        """Write the last-use updates still held in memory."""
+        if self.unsaved_hits:
+            try:
+                self.save_index()
+            except Exception as e:
+                # Only recency is lost, the files and their index entries are still there
+                self.logger.error(f"Failed to save artifact index {self.index_path}: {e}")
+
+    def adopt_existing_files(self):
+        adopted = []
+        for entry in os.scandir(self.root):
+            if entry.is_file() and is_legacy_artifact(entry.name):
+                stat = entry.stat()
+                adopted.append((stat.st_mtime, entry.path, stat.st_size))
+        for mtime, path, size in sorted(adopted):
+            key = "legacy/" + os.path.basename(path)
+            self.entries[key] = {"path": path, "files": [path], "size": size, "last_used": mtime}
+            self.total_bytes += size
+            self.total_files += 1
+        if adopted:
+            self.logger.info(f"Artifact store adopted {len(adopted)} existing files from {self.root}")
+        self.evict()
+        self.save_index()
+
+    def path(self, filename):
+        """Return the path of a new artifact file inside the store directory."""
+        return os.path.join(self.root, filename)
+
+    def get(self, key):
+        """Return the main file of a stored artifact and mark it as recently used, or None."""
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        if not all(os.path.exists(f) for f in entry["files"]):
+            # Removed behind our back, forget about it
+            self.forget(key)
+            self.save_index()
+            return None
+        entry["last_used"] = time.time()
+        self.entries.move_to_end(key)
+        self.unsaved_hits += 1
+        if self.unsaved_hits >= SAVE_EVERY_HITS:
+            self.save_index()
+        return entry["path"]
+
+    def put(self, key, path, related=()):
+        """
+        Register an artifact and evict the least recently used ones if over budget.
+        path: main file returned by get(); related: other files belonging to the artifact
+        """
+        if key in self.entries:
+            self.forget(key)
+        files = [f for f in list(related) + [path] if f and os.path.exists(f)]
+        size = sum(os.path.getsize(f) for f in files)
+        self.entries[key] = {"path": path, "files": files, "size": size, "last_used": time.time()}
+        self.total_bytes += size
+        self.total_files += len(files)
+        self.evict(keep=key)
+        self.save_index()
+        return path
+
+    def forget(self, key):
+        entry = self.entries.pop(key)
+        self.total_bytes -= entry.get("size", 0)
+        self.total_files -= len(entry.get("files", []))
+        return entry
+
+    def evict(self, keep=None):
+        while self.entries and (self.total_bytes > self.max_bytes or self.total_files > self.max_files):
+            key = next(iter(self.entries))
+            if key == keep:
+                # Never evict the artifact we are about to hand out
+                break
+            entry = self.forget(key)
+            for f in entry.get("files", []):
+                try:
+                    os.remove(f)
+                except FileNotFoundError:
+                    pass
+                except Exception as e:
+                    self.logger.error(f"Failed to remove artifact file {f}: {e}")
+            self.logger.info(f"Evicted artifact {key} ({entry.get('size', 0)} bytes)")
+
+
+def is_legacy_artifact(filename):
+    return (any(fnmatch.fnmatch(filename, pattern) for pattern in ADOPT_PATTERNS)
+            and not any(fnmatch.fnmatch(filename, pattern) for pattern in ADOPT_EXCLUDE))
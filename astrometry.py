@@ -4,17 +4,26 @@ import json
 import requests
 import logging
 import tools
-from credentials import credentials
+import botlog
+from skymap import skymap
+from artifacts import artifact_store
 from requests.adapters import HTTPAdapter
 from urllib3.util.retry import Retry
 
 BASE_URL = "https://nova.astrometry.net/api"   # HTTPS
+# Longest time (seconds) to wait for a solve before giving up
+SOLVE_TIMEOUT = 1200
 
 class astrometry():
-    def __init__(self, logger, API_KEY):
+    def __init__(self, logger, API_KEY, store=None):
         self.logger = logger
         self.API_KEY = API_KEY
         self.session = None  # API session token
+        self.results_bytes = 0  # size of the JSON bodies of the last get_job_results, for the log summary
+        # Size-bounded store for everything written to results/ (annotated images, sky maps)
+        self.store = store if store is not None else artifact_store(logger)
+        # Local renderer for the wide-field sky maps (replaces the nova sky_plot downloads)
+        self.skymap = skymap(logger, store=self.store)
         # Persistent HTTP session for all calls (API + images)
         self.http = requests.Session()
         self.http.headers.update({
@@ -128,6 +137,7 @@ class astrometry():
                 response = self.http.get(url, timeout=30)
                 response.raise_for_status()
                 results[field] = response.json()
+                self.results_bytes += len(response.content)
                 return results
             except Exception:
                 time.sleep(10)
@@ -135,6 +145,7 @@ class astrometry():
 
     def get_job_results(self, job_id):
         results = {}
+        self.results_bytes = 0
         fields = ["calibration","tags","machine_tags","objects_in_field","annotations","info"]
         for field in fields:
             results = self.get_job_result(field, results, job_id)
@@ -176,10 +187,17 @@ class astrometry():
           - also available: 'red_green_image_display', 'extraction_image_display' (JOBID)
         """
         url = f"https://nova.astrometry.net/{url_suffix}/{job_or_cal_id}"
-        outfile = f"results/{job_or_cal_id}_annotated_{suffix_name}.png"
+        outfile = self.store.path(f"{job_or_cal_id}_annotated_{suffix_name}.png")
         return self._download_result_image(url, outfile)
 
     def prepare_image_for_upload(self, job_id, url_suffix, suffix_name):
+        # Reuse the artifact if this job/calibration image was already prepared
+        key = f"{job_id}/{suffix_name}"
+        jpg_path = self.store.get(key)
+        if jpg_path:
+            self.logger.info(f"Reusing stored artifact {key}: {jpg_path}")
+            return jpg_path
+
         png_path = self.download_annotated_image_generic(job_id, url_suffix, suffix_name)
         if not png_path:
             return None
@@ -187,9 +205,12 @@ class astrometry():
         if not jpg_path:
             return None
         jpg_path = tools.ensure_image_size_under_limit(self.logger, jpg_path)
+        if jpg_path:
+            tools.remove_source_png(self.logger, png_path)
+            self.store.put(key, jpg_path)
         return jpg_path
 
-    def perform_astrometry_and_get_results(self, image_path):
+    def perform_astrometry_and_get_results(self, image_path, timeout=SOLVE_TIMEOUT):
         subid = self.upload_astrometry_file(image_path)
         time.sleep(5)
         self.logger.info("Checking astrometry submission status...")
@@ -200,7 +221,7 @@ class astrometry():
             if jobs and jobs[0] is not None and calibrations:
                 self.logger.info(f"Astrometry Jobs found: {jobs}")
                 break
-            if time.time() - start_time > 1200:
+            if time.time() - start_time > timeout:
                 raise Exception("Astrometry job took too long.")
             time.sleep(5)
 
@@ -215,30 +236,37 @@ class astrometry():
             elif status is False:
                 raise Exception("Astrometry job failed.")
             else:
-                if time.time() - start_time > 1200:
+                if time.time() - start_time > timeout:
                     raise Exception("Astrometry job took too long.")
                 self.logger.info("Job is still processing. Retrying in 10 seconds...")
                 time.sleep(10)
 
         self.logger.info(f"Fetching astrometry results for Job ID: {job_id}")
         results = self.get_job_results(job_id)
-        self.logger.info("Astrometry Results collected: %s", json.dumps(results, indent=2))
+        self.logger.info("Astrometry Results collected", extra={"fields": {"job_id": job_id, "calibration_id": calibration_id, **botlog.summarize_results(results), "bytes": self.results_bytes}})
+        # Full dump (including the potentially huge annotations list) only when dumps are enabled
+        if botlog.dumps.isEnabledFor(logging.DEBUG):
+            botlog.dumps.debug("Astrometry Results full dump: %s", json.dumps(results, indent=2))
 
         # Download and prepare various annotated images for upload (unchanged call sites)
         annotated_full_path    = self.prepare_image_for_upload(job_id,         "annotated_full",    "full")
         annotated_display_path = self.prepare_image_for_upload(job_id,         "annotated_display", "display")
-        skymap1_path           = self.prepare_image_for_upload(calibration_id, "sky_plot/zoom1",    "zoom1")
-        skymap2_path           = self.prepare_image_for_upload(calibration_id, "sky_plot/zoom2",    "zoom2")
+
+        # The wide sky map only depends on the field center and size: render it locally (cached by sky cell)
+        # and fall back to the nova sky_plot endpoint if local rendering fails or the catalog is too sparse there.
+        # The narrow zoom2 map needs fainter stars than the bundled catalog has, it always comes from nova.
+        calibration = results.get("calibration", {})
+        skymap1_path = self.skymap.render(calibration, "zoom1") or self.prepare_image_for_upload(calibration_id, "sky_plot/zoom1", "zoom1")
+        skymap2_path = self.prepare_image_for_upload(calibration_id, "sky_plot/zoom2", "zoom2")
 
         return results, annotated_full_path, annotated_display_path, skymap1_path, skymap2_path
 
 
 if __name__ == "__main__":
+    from credentials import credentials
+
     LOG_FILENAME = 'bot.log'
-    logging.basicConfig(filename=LOG_FILENAME,
-                        level=logging.INFO,
-                        format='%(asctime)s %(levelname)s: %(message)s',
-                        datefmt='%Y-%m-%d %H:%M:%S')
+    botlog.setup_logging(LOG_FILENAME, level=logging.INFO, queued=False)
     logger = logging.getLogger(__name__)
 
     astro = astrometry(logger, credentials["API_KEY"])
@@ -0,0 +1,319 @@
+"""
+Benchmark of the CPU-bound parts run on every reply, using the bundled fixtures in ressources/.
+
+    python benchmark.py                 # run and print time / peak memory / bytes written
+    python benchmark.py --save          # run and save the results as the new baseline
+    python benchmark.py --compare       # run and fail (exit 1) on regressions against the baseline
+
+Each case runs in a fresh process, inside a temporary directory, so memory figures and
+written files do not leak from one case to the next.
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import logging
+import argparse
+import tempfile
+import statistics
+import tracemalloc
+import multiprocessing
+from traffic import to_record
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+RESSOURCES = os.path.join(ROOT, "ressources")
+ANNOTATED_FULL = os.path.join(RESSOURCES, "12213519_annotated_full.png")
+TEST_IMAGE = os.path.join(RESSOURCES, "test-image.jpg")
+NOTIFICATIONS = os.path.join(RESSOURCES, "bench_notifications.json")
+BASELINE_FILE = os.path.join(ROOT, "benchmark_baseline.json")
+
+# Artifacts in the store of the store-backed table cases
+STORE_ENTRIES = 1500
+
+# A case is a regression when its median time, peak memory or bytes written grow by more than this ratio
+DEFAULT_TOLERANCE = 0.25
+
+logger = logging.getLogger("benchmark")
+logger.addHandler(logging.NullHandler())
+logger.propagate = False
+
+
+def fake_results(n_objects):
+    objects = [f"NGC {7000 + i}" for i in range(n_objects)]
+    return {
+        "calibration": {"ra": 350.2, "dec": 61.2, "radius": 0.9, "pixscale": 3.21, "orientation": 92.4, "parity": 1.0},
+        "objects_in_field": {"objects_in_field": objects},
+    }
+
+
+# --- case setups: each returns the function to time, run inside a fresh temporary directory ---
+
+def setup_convert_image_to_jpg(tmp):
+    import tools
+    png = os.path.join(tmp, "annotated_full.png")
+    shutil.copy(ANNOTATED_FULL, png)
+    return lambda: tools.convert_image_to_jpg(logger, png)
+
+
+def setup_ensure_image_size(max_size):
+    def setup(tmp):
+        import tools
+        png = os.path.join(tmp, "annotated_full.png")
+        shutil.copy(ANNOTATED_FULL, png)
+        jpg = tools.convert_image_to_jpg(logger, png)
+        # ensure_image_size_under_limit works in place: restore the original before every call
+        original = os.path.join(tmp, "original.jpg")
+        shutil.copy(jpg, original)
+
+        def run():
+            shutil.copyfile(original, jpg)
+            return tools.ensure_image_size_under_limit(logger, jpg, max_size)
+        return run
+    return setup
+
+
+def setup_create_table_image(n_objects):
+    def setup(tmp):
+        import tools
+        os.makedirs(os.path.join(tmp, "results"), exist_ok=True)
+        results = fake_results(n_objects)
+        return lambda: tools.create_table_image(logger, results)
+    return setup
+
+
+def setup_create_table_image_store(hit):
+    def setup(tmp):
+        import tools
+        from artifacts import artifact_store
+        store = artifact_store(logger, os.path.join(tmp, "results"))
+        # Index of a store in production: the cost of put() grows with the number of artifacts
+        for i in range(STORE_ENTRIES):
+            store.entries[f"bench/{i}"] = {"path": f"bench_{i}.jpg", "files": [], "size": 0, "last_used": i}
+        store.save_index()
+        results = fake_results(25)
+
+        def run():
+            if not hit:
+                # New field every call, as for real jobs: hash, render, put
+                results["calibration"]["ra"] = (results["calibration"]["ra"] + 0.01) % 360
+            return tools.create_table_image(logger, results, store=store)
+        return run
+    return setup
+
+
+def setup_generate_text(tmp):
+    import tools
+    results = fake_results(25)
+    return lambda: tools.generate_text(results)
+
+
+def setup_triage(cached):
+    def setup(tmp):
+        from triage import image_triage
+        screener = image_triage(logger, cache_path=None)
+
+        def run():
+            if not cached:
+                screener.cache.clear()
+                screener.bands.clear()
+            return screener.check(TEST_IMAGE)
+        return run
+    return setup
+
+
+class recorded_client():
+    """Serves list_notifications/get_post_thread from the recorded fixture instead of the network."""
+
+    def __init__(self, payload):
+        self.notifications = to_record({"notifications": payload["notifications"]})
+        self.threads = to_record(payload["threads"])
+        self.app = self
+        self.bsky = self
+        self.notification = self
+        self.feed = self
+
+    def list_notifications(self):
+        return self.notifications
+
+    def get_post_thread(self, params):
+        return self.threads[params["uri"]]
+
+
+def setup_check_valid_notifications(tmp):
+    from bluesky import bluesky
+    with open(NOTIFICATIONS, 'r') as f:
+        payload = json.load(f)
+    # Build the instance without logging in, only the parsing is measured
+    bs = bluesky.__new__(bluesky)
+    bs.client = recorded_client(payload)
+    bs.botname = payload["botname"]
+    bs.logger = logger
+    bs.claims = None
+    bs.active_claim = None
+    bs.PROCESSED_NOTIFICATIONS_FILE = os.path.join(tmp, "processed_notifications.json")
+    bs.download_image = lambda author_did, cid, alt_link, save_path=None: os.path.join(tmp, f"{cid}.jpg")
+
+    def run():
+        # Parse the whole recorded page, one valid mention per call as in the bot loop
+        bs.processed_notifications = set()
+        found = []
+        while True:
+            result = bs.Check_valid_notifications()
+            if result is None:
+                return found
+            found.append(result)
+    return run
+
+
+CASES = {
+    "convert_image_to_jpg": (setup_convert_image_to_jpg, 10),
+    "ensure_image_size_under_limit": (setup_ensure_image_size(900 * 1024), 10),
+    "ensure_image_size_under_limit_100k": (setup_ensure_image_size(100 * 1024), 5),
+    "create_table_image_5": (setup_create_table_image(5), 10),
+    "create_table_image_25": (setup_create_table_image(25), 10),
+    "create_table_image_500": (setup_create_table_image(500), 10),
+    "create_table_image_store": (setup_create_table_image_store(False), 10),
+    "create_table_image_store_hit": (setup_create_table_image_store(True), 200),
+    "generate_text": (setup_generate_text, 1000),
+    "check_valid_notifications": (setup_check_valid_notifications, 200),
+    "triage": (setup_triage(False), 20),
+    "triage_cached": (setup_triage(True), 1000),
+}
+
+
+def written_bytes():
+    # Bytes passed to write() by this process (Linux only)
+    try:
+        with open("/proc/self/io", 'r') as f:
+            for line in f:
+                if line.startswith("wchar:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def run_case(name, repeat, out_queue):
+    setup, number = CASES[name]
+    sys.path.insert(0, ROOT)
+    tmp = tempfile.mkdtemp(prefix="bench_")
+    cwd = os.getcwd()
+    try:
+        os.chdir(tmp)
+        func = setup(tmp)
+        func()  # warm up imports and caches
+        timings = []
+        written_before = written_bytes()
+        for _ in range(repeat):
+            start = time.perf_counter()
+            for _ in range(number):
+                func()
+            timings.append((time.perf_counter() - start) / number)
+        written_after = written_bytes()
+        calls = repeat * number
+
+        # Python heap peak of a single call, traced separately so tracing does not skew the timings
+        tracemalloc.start()
+        func()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        out_queue.put({
+            "name": name,
+            "calls": calls,
+            "median_s": statistics.median(timings),
+            "min_s": min(timings),
+            "peak_kb": peak / 1024,
+            # Process high-water mark, includes the PIL pixel buffers that tracemalloc does not see
+            "max_rss_kb": None if resource is None else resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            "bytes_written_per_call": None if written_before is None else (written_after - written_before) / calls,
+        })
+    except Exception as e:
+        out_queue.put({"name": name, "error": repr(e)})
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+def run_all(names, repeat):
+    ctx = multiprocessing.get_context("spawn")
+    results = {}
+    for name in names:
+        out_queue = ctx.Queue()
+        process = ctx.Process(target=run_case, args=(name, repeat, out_queue))
+        process.start()
+        results[name] = out_queue.get()
+        process.join()
+    return results
+
+
+def print_results(results, baseline=None):
+    print(f"{'case':<38}{'median':>12}{'min':>12}{'peak mem':>12}{'max rss':>12}{'written':>12}{'vs base':>10}")
+    for name, r in results.items():
+        if "error" in r:
+            print(f"{name:<38}ERROR {r['error']}")
+            continue
+        written = "-" if r["bytes_written_per_call"] is None else f"{r['bytes_written_per_call'] / 1024:.1f}KB"
+        rss = "-" if r["max_rss_kb"] is None else f"{r['max_rss_kb']}KB"
+        ratio = ""
+        if baseline and name in baseline and "median_s" in baseline[name]:
+            ratio = f"{r['median_s'] / baseline[name]['median_s']:.2f}x"
+        print(f"{name:<38}{r['median_s'] * 1000:>10.3f}ms{r['min_s'] * 1000:>10.3f}ms{r['peak_kb']:>10.0f}KB{rss:>12}{written:>12}{ratio:>10}")
+
+
+def find_regressions(results, baseline, tolerance):
+    regressions = []
+    for name, r in results.items():
+        base = baseline.get(name)
+        if not base or "error" in r or "error" in base:
+            continue
+        for metric in ("median_s", "peak_kb", "bytes_written_per_call"):
+            if r.get(metric) is None or not base.get(metric):
+                continue
+            if r[metric] > base[metric] * (1 + tolerance):
+                regressions.append(f"{name}: {metric} {base[metric]:.6g} -> {r[metric]:.6g}")
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the image pipeline and notification parsing.")
+    parser.add_argument("cases", nargs="*", help=f"cases to run (default: all): {', '.join(CASES)}")
+    parser.add_argument("--repeat", type=int, default=5, help="number of timed rounds per case")
+    parser.add_argument("--save", action="store_true", help=f"save the results as baseline ({BASELINE_FILE})")
+    parser.add_argument("--compare", action="store_true", help="exit with status 1 if a case regressed against the baseline")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE, help="allowed relative slowdown before flagging a regression")
+    args = parser.parse_args()
+
+    names = args.cases or list(CASES)
+    unknown = [n for n in names if n not in CASES]
+    if unknown:
+        parser.error(f"unknown cases: {', '.join(unknown)}")
+
+    baseline = None
+    if os.path.exists(BASELINE_FILE):
+        with open(BASELINE_FILE, 'r') as f:
+            baseline = json.load(f)
+
+    results = run_all(names, args.repeat)
+    print_results(results, baseline)
+
+    if args.save:
+        merged = dict(baseline or {})
+        merged.update(results)
+        with open(BASELINE_FILE, 'w') as f:
+            json.dump(merged, f, indent=2)
+        print(f"Baseline saved to {BASELINE_FILE}")
+
+    if args.compare:
+        if not baseline:
+            print("No baseline to compare against, run with --save first.")
+            sys.exit(1)
+        regressions = find_regressions(results, baseline, args.tolerance)
+        for regression in regressions:
+            print("REGRESSION", regression)
+        sys.exit(1 if regressions else 0)
@@ -1,21 +1,31 @@
 import os
+import logging
 from atproto import Client
 import json
 from datetime import datetime
 import requests
+import claims as claims_module
+import botlog
 
 class bluesky():
 
-    def __init__(self,logger,botname,username,password,PROCESSED_NOTIFICATIONS_FILE):
+    def __init__(self,logger,botname,username,password,PROCESSED_NOTIFICATIONS_FILE,client=None,claims=None):
         # Initialize the bluesky class with the given parameters
         # logger: logger object for logging info and errors
         # botname: the bot's username mention (e.g. '@kat-astro-bot')
         # username, password: credentials for logging into Bluesky
         # PROCESSED_NOTIFICATIONS_FILE: file to track processed notifications
-        self.client = Client()  # Create an instance of the Bluesky client
+        # client: already logged-in client to use instead of creating one (e.g. trace replay)
+        # claims: shared claim store (e.g. claims.sqlite_claims) when several workers read the same notifications
+        if client is None:
+            client = Client()  # Create an instance of the Bluesky client
+            client.login(username, password)  # Log in to the Bluesky client
+        self.client = client
         self.botname=botname    # Store the bot name to check mentions
-        self.client.login(username, password)  # Log in to the Bluesky client
-        self.PROCESSED_NOTIFICATIONS_FILE = 'processed_notifications.json'  # Set the notifications file
+        self.http = requests.Session()  # HTTP session for the image downloads from the CDN
+        self.PROCESSED_NOTIFICATIONS_FILE = PROCESSED_NOTIFICATIONS_FILE  # Set the notifications file
+        self.claims = claims
+        self.active_claim = None  # notification URI claimed by this worker and not completed yet
         self.processed_notifications = self.load_processed_notifications()  # Load processed notifications
         self.logger=logger  # Store the logger
 
@@ -36,7 +46,14 @@ class bluesky():
         with open(image_path, 'rb') as f:
             image_data = f.read()
         image_blob = self.client.upload_blob(image_data)
-        self.logger.info("Uploaded image blob: %s", image_blob)
+        self.logger.info("Uploaded image blob", extra={"fields": {
+            "path": image_path,
+            "cid": image_blob.blob.ref.link,
+            "mime_type": image_blob.blob.mime_type,
+            "bytes": image_blob.blob.size,
+        }})
+        if botlog.dumps.isEnabledFor(logging.DEBUG):
+            botlog.dumps.debug("Uploaded image blob full dump: %s", image_blob)
 
         # Construct the blob reference dictionary for embedding
         image_blob_ref = {
@@ -54,10 +71,10 @@ class bluesky():
         try:
             image_url = f"https://cdn.bsky.app/img/feed_fullsize/plain/{author_did}/{cid}"
             headers = {'User-Agent': 'YourBotName/1.0'}
-            response = requests.get(image_url, headers=headers)
+            response = self.http.get(image_url, headers=headers)
             if not response.status_code == 200:
                 #some link are indirect try alt link in case of failure
-                response = requests.get(alt_link, headers=headers)
+                response = self.http.get(alt_link, headers=headers)
             if  response.status_code == 200:
                 # Save the downloaded image locally
                 with open(save_path, 'wb') as file:
@@ -79,11 +96,27 @@ class bluesky():
         notifications = self.client.app.bsky.notification.list_notifications()['notifications']
         #image_cid=None
         for notification in notifications:
+            # The previous notification was handled without returning it, it is done
+            self.complete_claim()
+
             # Skip if notification already processed
             if notification['uri'] in self.processed_notifications:
                 continue
                 #pass
 
+            # With several workers, only process the notifications we hold the lease on
+            if self.claims is not None:
+                status = self.claims.claim(notification['uri'])
+                if status == claims_module.BUSY:
+                    # Another worker is on it, but keep it unprocessed here in case its lease expires
+                    continue
+                if status == claims_module.DONE:
+                    # Already handled by another worker
+                    self.processed_notifications.add(notification['uri'])
+                    self.save_processed_notifications()
+                    continue
+                self.active_claim = notification['uri']
+
             # Mark notification as processed
             self.processed_notifications.add(notification['uri'])
             self.save_processed_notifications()
@@ -186,8 +219,31 @@ class bluesky():
                                 # Construct a dictionary with post IDs for replying
                                 post_id = { "root_uri" : root_uri, "root_cid" : root_cid, "parent_uri":parent_uri,"parent_cid":parent_cid}
                                 return post_id, downloaded_image_path
+        self.complete_claim()
         return None
 
+    def complete_claim(self):
+        # Mark the notification returned by Check_valid_notifications as done for all the workers
+        if self.claims is not None and self.active_claim is not None:
+            self.claims.complete(self.active_claim)
+        self.active_claim = None
+
+    def claim_lost(self):
+        # True if another worker may have taken over the notification being processed (lease not renewed in time)
+        # Check it right before posting anything for that notification
+        if self.claims is None or self.active_claim is None:
+            return False
+        try:
+            if self.claims.still_held(self.active_claim):
+                return False
+        except Exception as e:
+            # Can't tell who owns it: don't risk a second reply, the lease expires and the notification is retried
+            self.logger.error(f"Error renewing the lease on {self.active_claim}: {e}")
+        self.logger.warning(f"Lease on {self.active_claim} lost, not replying to it")
+        # Not ours anymore: don't mark it done
+        self.active_claim = None
+        return True
+
 
     def post_reply(self,images_list,post_text,post_id):
         # Post a reply with given images and text
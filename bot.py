@@ -1,33 +1,109 @@
+import os
+import socket
 import logging
+import argparse
 import tools
-from credentials import credentials
+import botlog
+import traffic
+import astrometry as astrometry_module
 from astrometry import astrometry
 from bluesky import bluesky
+from artifacts import artifact_store
+from claims import open_claims
+from triage import image_triage, REJECT, DOUBTFUL
 import time
 
-if __name__ == "__main__":
-    # Configure logger to log messages to 'bot.log'
-    # Set the logging level to INFO and specify a format and date format for the logs
-    LOG_FILENAME = 'bot.log'
-    logging.basicConfig(filename=LOG_FILENAME,
-                    level=logging.INFO,
-                    format='%(asctime)s %(levelname)s: %(message)s',
-                    datefmt='%Y-%m-%d %H:%M:%S')
-    logger = logging.getLogger(__name__)
-
-    # Log a message indicating that the bot is listening for mentions
-    logger.info("🤖 Bot is listening for mentions...")
-
-    # Create an instance of the bluesky class to handle Bluesky operations
-    # Provide logger, bot name, username/password for Bluesky, and the processed notifications file
-    bs = bluesky(logger, credentials["botname"], credentials["BLUESKY_USERNAME"], credentials["BLUESKY_PASSWORD"], 'processed_notifications.json')
+# Set to a file name (e.g. 'trace.jsonl') to record the notification pages, threads and
+# nova/CDN responses with their timings, for offline replay with traffic.py
+TRACE_FILENAME = None
+# Solve time budget (seconds) for images the triage finds doubtful (few stars, bright background...)
+DOUBTFUL_SOLVE_TIMEOUT = 300
+
+
+def handle_mention(logger, bs, astro, store, post_id, image_path, triage=None):
+    # If no image was downloaded, reply with an error
+    if not image_path:
+        fail_message = "image extraction failed. @quantumkat.bsky.social"
+        if bs.claim_lost():
+            return
+        bs.post_reply({}, fail_message, post_id)
+        bs.complete_claim()
+        return
+
+    # Cheap local check first: don't hold a solver slot for selfies, screenshots or blank frames
+    timeout = astrometry_module.SOLVE_TIMEOUT
+    if triage is not None:
+        verdict, reason = triage.check(image_path)
+        if verdict == REJECT:
+            if bs.claim_lost():
+                return
+            bs.post_reply({}, f"Sorry, this image can't be solved: {reason}.", post_id)
+            bs.complete_claim()
+            return
+        if verdict == DOUBTFUL:
+            timeout = DOUBTFUL_SOLVE_TIMEOUT
+
+    # Log into astrometry.net before performing astrometry on the image
+    #added retry on fail, if astrometry server is down
+    while (True):
+        try:
+            astro.login_astrometry()
+            break
+        except:
+            #astrometry server is down, just wait
+            time.sleep(120)
+
+    try:
+        # Perform astrometry on the downloaded image and get results and annotated images
+        # If the astrometry server is down or times out, an exception will be raised
+        results, annotated_full_path, annotated_display_path, skymap1_path, skymap2_path = astro.perform_astrometry_and_get_results(image_path, timeout)
+    except Exception as e:
+        # If an error occurs during astrometry, log it
+        logger.error("Error performing astrometry: %s", e)
+        # Reply to the user indicating that astrometry failed
+        fail_message = "Astrometry failed. @quantumkat.bsky.social"
+        if bs.claim_lost():
+            return
+        bs.post_reply({}, fail_message, post_id)
+        bs.complete_claim()
+        return
+
+    # Generate a reply text and alt text for the images from the astrometry results
+    reply_text, reply_alt_text = tools.generate_text(results)
+
+    # Create a table image summarizing the objects and other info, and get its path
+    table_image_path = tools.create_table_image(logger, results, store=store)
+
+    # Prepare a list of images to post in the reply: annotated full, table, and two sky maps
+    images_list = [
+        (annotated_full_path, reply_alt_text),
+        (table_image_path, "Objects and Information Table"),
+        (skymap1_path, "Sky map - Zoom level 1"),
+        (skymap2_path, "Sky map - Zoom level 2"),
+    ]
+
+    success=False
+    while not success:
+        # With several workers, another one takes the notification over if our lease expired: don't reply twice
+        if bs.claim_lost():
+            return
+        try:
+            # Post a reply with the images and the generated text
+            bs.post_reply(images_list, reply_text, post_id)
+            # Replied: mark it done right away, a crash during the repost or the pause must not let
+            # another worker reclaim it and reply a second time
+            bs.complete_claim()
+            bs.repost_original_post(post_id["parent_uri"],post_id["parent_cid"])
+            success=True
+            time.sleep(120)
+        except Exception as e:
+            logger.error("Error posting reply: %s", e)
 
-    # Create an instance of the astrometry class for handling astrometry.net operations
-    astro = astrometry(logger, credentials["API_KEY"])
 
-    # Enter an infinite loop to continuously check for notifications
-    while True:
-        # Sleep for 1 second before checking again
+def run(logger, bs, astro, store, stop=None, triage=None):
+    # Loop continuously checking for notifications, until stop() returns True (forever if None)
+    while not (stop and stop()):
+        # Sleep for 10 seconds before checking again
         time.sleep(10)
         # Check for valid notifications (mentions with images)
         results = bs.Check_valid_notifications()
@@ -35,65 +111,54 @@ if __name__ == "__main__":
         # If no valid mentions, continue looping
         if results is None:
             continue
-        #continue
         # Extract the post_id and the image_path from the results
         post_id, image_path = results
+        handle_mention(logger, bs, astro, store, post_id, image_path, triage)
+        # handle_mention marks the claim done as soon as it replied; release it in any case
+        bs.complete_claim()
 
-        # If no image was downloaded, continue looping
-        if not image_path:
-            fail_message = "image extraction failed. @quantumkat.bsky.social"
-            bs.post_reply({}, fail_message, post_id)
-            continue
 
-        # Log into astrometry.net before performing astrometry on the image
-        #added retry on fail, if astrometry server is down
-        while (True):
-            try:
-                astro.login_astrometry()
-                break
-            except:
-                #astrometry server is down, just wait
-                time.sleep(120)
+if __name__ == "__main__":
+    from credentials import credentials
 
+    parser = argparse.ArgumentParser(description="Bluesky astrometry bot.")
+    parser.add_argument("--worker", default="1", help="name of this worker, unique on this host")
+    parser.add_argument("--claims", help="claims shared by several workers: SQLite file (same host) or redis:// URL (several hosts); single instance if not set")
+    args = parser.parse_args()
 
+    # Configure logger to log messages to 'bot.log'
+    # Records are queued and written as one-line JSON by a background thread, with size-based rotation.
+    # Set LOG_DUMPS to True to also get the full results/blob dumps (logger 'bot.dumps'),
+    # without the DEBUG output of the libraries that LOG_LEVEL = logging.DEBUG brings.
+    LOG_FILENAME = 'bot.log'
+    LOG_LEVEL = logging.INFO
+    LOG_DUMPS = False
+    botlog.setup_logging(LOG_FILENAME, level=LOG_LEVEL, queued=True, dumps=LOG_DUMPS)
+    logger = logging.getLogger(__name__)
 
+    # Log a message indicating that the bot is listening for mentions
+    logger.info("🤖 Bot is listening for mentions...")
 
-        try:
-            # Perform astrometry on the downloaded image and get results and annotated images
-            # If the astrometry server is down or times out, an exception will be raised
-            results, annotated_full_path, annotated_display_path, skymap1_path, skymap2_path = astro.perform_astrometry_and_get_results(image_path)
-        except Exception as e:
-            # If an error occurs during astrometry, log it
-            logger.error("Error performing astrometry: %s", e)
-            # Reply to the user indicating that astrometry failed
-            fail_message = "Astrometry failed. @quantumkat.bsky.social"
-            bs.post_reply({}, fail_message, post_id)            
-            # Continue to the next iteration of the loop
-            continue
+    # Create an instance of the bluesky class to handle Bluesky operations
+    # Provide logger, bot name, username/password for Bluesky, and the processed notifications file
+    # With --claims, workers lease each notification in the shared database so that only one replies
+    claims = None
+    if args.claims:
+        claims = open_claims(logger, f"{socket.gethostname()}:{args.worker}:{os.getpid()}", args.claims)
+        logger.info(f"Worker {claims.worker_id} sharing notifications through {args.claims}")
+    bs = bluesky(logger, credentials["botname"], credentials["BLUESKY_USERNAME"], credentials["BLUESKY_PASSWORD"], 'processed_notifications.json', claims=claims)
+
+    # Create the size-bounded artifact store shared by everything written to results/
+    store = artifact_store(logger)
+
+    # Create an instance of the astrometry class for handling astrometry.net operations
+    astro = astrometry(logger, credentials["API_KEY"], store)
+
+    # Pre-solve triage of the images, with a cache of earlier verdicts
+    triage = image_triage(logger)
+
+    # Optionally record all network traffic for offline replay
+    if TRACE_FILENAME:
+        traffic.capture(logger, TRACE_FILENAME, bs, astro)
 
-        # Generate a reply text and alt text for the images from the astrometry results
-        reply_text, reply_alt_text = tools.generate_text(results)
-
-        # Create a table image summarizing the objects and other info, and get its path
-        table_image_path = tools.create_table_image(logger, results)
-
-        # Prepare a list of images to post in the reply: annotated full, table, and two sky maps
-        images_list = [
-            (annotated_full_path, reply_alt_text),
-            (table_image_path, "Objects and Information Table"),
-            (skymap1_path, "Sky map - Zoom level 1"),
-            (skymap2_path, "Sky map - Zoom level 2"),
-        ]
-
-        success=False
-        while not success:
-            try:
-                # Post a reply with the images and the generated text
-                bs.post_reply(images_list, reply_text, post_id)
-                bs.repost_original_post(post_id["parent_uri"],post_id["parent_cid"])
-                success=True
-                time.sleep(120)
-            except Exception as e:
-                logger.error("Error posting reply: %s", e)
-
-        
+    run(logger, bs, astro, store, triage=triage)
@@ -0,0 +1,110 @@
+import logging
+import logging.handlers
+import json
+import queue
+import atexit
+
+
+# Rotate the log file once it reaches this size, keeping BACKUP_COUNT old files
+MAX_LOG_BYTES = 10 * 1024 * 1024
+BACKUP_COUNT = 5
+DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
+TEXT_FORMAT = '%(asctime)s %(levelname)s: %(message)s'
+# Full dumps (astrometry results, uploaded blobs) go through this logger at DEBUG level, so they can be
+# turned on with setup_logging(dumps=True) without the DEBUG output of every library
+DUMPS_LOGGER = "bot.dumps"
+dumps = logging.getLogger(DUMPS_LOGGER)
+
+
+class json_formatter(logging.Formatter):
+    """
+    Format each record as one compact JSON line, merging the structured fields passed with extra={"fields": {...}}.
+    Fields named like a standard key (time, level, logger, msg, exc) are written as 'field_<name>'.
+    """
+
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record, DATE_FORMAT),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        fields = getattr(record, "fields", None)
+        if fields:
+            standard = set(entry) | {"exc"}
+            for key, value in fields.items():
+                entry["field_" + key if key in standard else key] = value
+        return json.dumps(entry, separators=(",", ":"), default=str, ensure_ascii=False)
+
+
+class text_formatter(logging.Formatter):
+    """Classic text format, with the structured fields appended as compact JSON."""
+
+    def format(self, record):
+        line = super().format(record)
+        fields = getattr(record, "fields", None)
+        if fields:
+            line += " " + json.dumps(fields, separators=(",", ":"), default=str, ensure_ascii=False)
+        return line
+
+
+def setup_logging(filename, level=logging.INFO, queued=True, dumps=False, max_bytes=MAX_LOG_BYTES, backup_count=BACKUP_COUNT):
+    """
+    Configure the root logger to write to a size-rotated file.
+    queued=True: records are put on an in-memory queue and written as one-line JSON by a background
+    QueueListener thread, so the processing thread never blocks on disk I/O.
+    queued=False: synchronous text logging, same output format as before.
+    dumps=True: also write the full dumps of the DUMPS_LOGGER logger, whatever the level.
+    Returns the function stopping the QueueListener (or None), also called automatically at exit.
+    """
+    file_handler = logging.handlers.RotatingFileHandler(filename, maxBytes=max_bytes, backupCount=backup_count, encoding="utf-8")
+    root = logging.getLogger()
+    root.setLevel(level)
+    logging.getLogger(DUMPS_LOGGER).setLevel(logging.DEBUG if dumps else logging.INFO)
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+
+    if not queued:
+        file_handler.setFormatter(text_formatter(TEXT_FORMAT, datefmt=DATE_FORMAT))
+        root.addHandler(file_handler)
+        return None
+
+    file_handler.setFormatter(json_formatter())
+    log_queue = queue.SimpleQueue()
+    root.addHandler(logging.handlers.QueueHandler(log_queue))
+    listener = logging.handlers.QueueListener(log_queue, file_handler, respect_handler_level=True)
+    listener.start()
+    stopped = []
+
+    def stop_listener():
+        # Flush whatever is still queued when the bot exits, only once
+        if not stopped:
+            stopped.append(True)
+            listener.stop()
+
+    atexit.register(stop_listener)
+    return stop_listener
+
+
+def summarize_results(results):
+    """Return a compact summary (ids, counts) of an astrometry results dict, for logging."""
+    cal = results.get("calibration", {}) or {}
+    objects = (results.get("objects_in_field", {}) or {}).get("objects_in_field", [])
+    annotations = (results.get("annotations", {}) or {}).get("annotations", [])
+    info = results.get("info", {}) or {}
+    summary = {
+        "keys": sorted(results.keys()),
+        "ra": cal.get("ra"),
+        "dec": cal.get("dec"),
+        "radius": cal.get("radius"),
+        "pixscale": cal.get("pixscale"),
+        "objects": len(objects),
+        "annotations": len(annotations),
+        "tags": len((results.get("tags", {}) or {}).get("tags", [])),
+        "machine_tags": len((results.get("machine_tags", {}) or {}).get("tags", [])),
+    }
+    if "original_filename" in info:
+        summary["original_filename"] = info["original_filename"]
+    return summary
@@ -0,0 +1,217 @@
+import time
+import sqlite3
+import threading
+
+
+# Default shared database. WAL mode needs every worker on the same host: SQLite locking does not
+# work over network filesystems, workers on several hosts use redis_claims instead
+CLAIMS_DB = "claims.sqlite"
+# A claim not renewed for this long is considered abandoned and can be taken by another worker
+LEASE_SECONDS = 300
+# Completed claims are kept this long so late workers still see them as done
+KEEP_DONE_SECONDS = 30 * 24 * 3600
+# Prefix of the keys written by redis_claims
+REDIS_PREFIX = "astrobot:"
+
+CLAIMED = "claimed"  # the notification is ours, process it
+BUSY = "busy"        # another worker holds a live lease on it
+DONE = "done"        # already fully processed by some worker
+
+
+class lease_claims():
+    """
+    Notification claims shared between bot workers, common part of the backends.
+
+    A worker claims a notification URI with a lease, renews it from a background thread while
+    processing, and marks it done afterwards. Leases of crashed workers expire and are reclaimed.
+    Backends implement try_claim(), renew() and mark_done() atomically across the workers.
+    """
+
+    def __init__(self, logger, worker_id, lease_seconds=LEASE_SECONDS):
+        # logger: logger object for logging info and errors
+        # worker_id: unique name of this worker (e.g. 'host:1')
+        self.logger = logger
+        self.worker_id = worker_id
+        self.lease_seconds = lease_seconds
+        self.held = set()  # URIs claimed by this worker and not completed yet
+        self.lost = set()  # URIs whose lease could not be renewed, another worker may have taken them
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+
+    def start(self):
+        # Renew the leases of everything we hold, well before they expire
+        self.heartbeat_thread = threading.Thread(target=self.heartbeat_loop, name="claims-heartbeat", daemon=True)
+        self.heartbeat_thread.start()
+
+    def claim(self, uri):
+        """Try to take the lease on a notification URI. Returns CLAIMED, BUSY or DONE."""
+        status = self.try_claim(uri)
+        if status == CLAIMED:
+            with self.lock:
+                self.held.add(uri)
+                self.lost.discard(uri)
+        return status
+
+    def heartbeat(self, uri):
+        """Extend our lease on a URI. Returns False if the lease was lost to another worker."""
+        renewed = self.renew(uri)
+        if not renewed:
+            self.logger.warning(f"Lost the lease on {uri}")
+            with self.lock:
+                self.held.discard(uri)
+                self.lost.add(uri)
+        return renewed
+
+    def still_held(self, uri):
+        """Renew our lease on a URI right now. Returns False if it was lost, then nothing must be posted for it."""
+        with self.lock:
+            if uri in self.lost:
+                return False
+        return self.heartbeat(uri)
+
+    def complete(self, uri):
+        """Mark a claimed notification as fully processed, no worker will take it again."""
+        with self.lock:
+            self.held.discard(uri)
+            self.lost.discard(uri)
+        self.mark_done(uri)
+
+    def heartbeat_loop(self):
+        while not self.stopped.wait(self.lease_seconds / 3):
+            with self.lock:
+                held = list(self.held)
+            for uri in held:
+                try:
+                    self.heartbeat(uri)
+                except Exception as e:
+                    self.logger.error(f"Error renewing the lease on {uri}: {e}")
+
+    def close(self):
+        self.stopped.set()
+        self.heartbeat_thread.join()
+
+
+class sqlite_claims(lease_claims):
+    """
+    Claims in a SQLite database. All the workers must run on the same host as the database file
+    (WAL mode, local file locks); use redis_claims for workers on several hosts.
+    """
+
+    def __init__(self, logger, worker_id, path=CLAIMS_DB, lease_seconds=LEASE_SECONDS):
+        # path: SQLite database shared by all the workers
+        super().__init__(logger, worker_id, lease_seconds)
+        self.path = path
+
+        with self.connect() as db:
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("CREATE TABLE IF NOT EXISTS claims (uri TEXT PRIMARY KEY, owner TEXT NOT NULL, expires REAL NOT NULL, done INTEGER NOT NULL DEFAULT 0)")
+            db.execute("DELETE FROM claims WHERE done = 1 AND expires < ?", (time.time() - KEEP_DONE_SECONDS,))
+        self.start()
+
+    def connect(self):
+        # One short-lived connection per operation, usable from the heartbeat thread too
+        return sqlite3.connect(self.path, timeout=30, isolation_level=None)
+
+    def try_claim(self, uri):
+        now = time.time()
+        db = self.connect()
+        try:
+            # BEGIN IMMEDIATE takes the write lock, so the read-then-write below is atomic across workers
+            db.execute("BEGIN IMMEDIATE")
+            row = db.execute("SELECT owner, expires, done FROM claims WHERE uri = ?", (uri,)).fetchone()
+            if row is None:
+                db.execute("INSERT INTO claims (uri, owner, expires) VALUES (?, ?, ?)", (uri, self.worker_id, now + self.lease_seconds))
+                status = CLAIMED
+            elif row[2]:
+                status = DONE
+            elif row[0] == self.worker_id or row[1] < now:
+                if row[0] != self.worker_id:
+                    self.logger.warning(f"Reclaiming expired lease on {uri} from worker {row[0]}")
+                db.execute("UPDATE claims SET owner = ?, expires = ? WHERE uri = ?", (self.worker_id, now + self.lease_seconds, uri))
+                status = CLAIMED
+            else:
+                status = BUSY
+            db.execute("COMMIT")
+        except Exception:
+            db.execute("ROLLBACK")
+            raise
+        finally:
+            db.close()
+        return status
+
+    def renew(self, uri):
+        db = self.connect()
+        try:
+            cursor = db.execute("UPDATE claims SET expires = ? WHERE uri = ? AND owner = ? AND done = 0",
+                                (time.time() + self.lease_seconds, uri, self.worker_id))
+            return cursor.rowcount == 1
+        finally:
+            db.close()
+
+    def mark_done(self, uri):
+        db = self.connect()
+        try:
+            db.execute("UPDATE claims SET done = 1, expires = ? WHERE uri = ? AND owner = ?", (time.time(), uri, self.worker_id))
+        finally:
+            db.close()
+
+
+# Each script runs atomically on the Redis server. KEYS[1]: lease key, KEYS[2]: done key
+REDIS_CLAIM = """
+if redis.call('EXISTS', KEYS[2]) == 1 then return 'done' end
+local owner = redis.call('GET', KEYS[1])
+if owner and owner ~= ARGV[1] then return 'busy' end
+redis.call('SET', KEYS[1], ARGV[1], 'PX', ARGV[2])
+return 'claimed'
+"""
+REDIS_RENEW = """
+if redis.call('GET', KEYS[1]) ~= ARGV[1] then return 0 end
+return redis.call('PEXPIRE', KEYS[1], ARGV[2])
+"""
+REDIS_DONE = """
+if redis.call('GET', KEYS[1]) ~= ARGV[1] then return 0 end
+redis.call('SET', KEYS[2], ARGV[1], 'EX', ARGV[2])
+redis.call('DEL', KEYS[1])
+return 1
+"""
+
+
+class redis_claims(lease_claims):
+    """
+    Claims in a Redis server, for workers on several hosts (requires the 'redis' package).
+    A lease is a key expiring after lease_seconds, so abandoned leases disappear by themselves.
+    """
+
+    def __init__(self, logger, worker_id, url, lease_seconds=LEASE_SECONDS):
+        # url: Redis server shared by all the workers, e.g. 'redis://claims-host:6379/0'
+        super().__init__(logger, worker_id, lease_seconds)
+        try:
+            import redis
+        except ImportError:
+            raise RuntimeError("Claims on a Redis server need the 'redis' package (pip install redis)")
+        self.url = url
+        self.redis = redis.Redis.from_url(url, decode_responses=True, socket_timeout=30)
+        self.redis.ping()
+        self.claim_script = self.redis.register_script(REDIS_CLAIM)
+        self.renew_script = self.redis.register_script(REDIS_RENEW)
+        self.done_script = self.redis.register_script(REDIS_DONE)
+        self.start()
+
+    def keys(self, uri):
+        return [REDIS_PREFIX + "lease:" + uri, REDIS_PREFIX + "done:" + uri]
+
+    def try_claim(self, uri):
+        return self.claim_script(keys=self.keys(uri), args=[self.worker_id, int(self.lease_seconds * 1000)])
+
+    def renew(self, uri):
+        return self.renew_script(keys=self.keys(uri), args=[self.worker_id, int(self.lease_seconds * 1000)]) == 1
+
+    def mark_done(self, uri):
+        self.done_script(keys=self.keys(uri), args=[self.worker_id, KEEP_DONE_SECONDS])
+
+
+def open_claims(logger, worker_id, location):
+    """Claims backend for a --claims location: a redis:// (or rediss://) URL, or a local SQLite file."""
+    if location.startswith(("redis://", "rediss://")):
+        return redis_claims(logger, worker_id, location)
+    return sqlite_claims(logger, worker_id, location)
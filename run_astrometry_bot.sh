@@ -6,15 +6,36 @@ SCRIPT_PATH="/home/kat/astrometry/bot.py"
 VENV_ACTIVATE="/home/kat/astrometry/venv/bin/activate"
 # Directory containing your script
 SCRIPT_DIR="/home/kat/astrometry"
+# Number of bot workers to run on this host. With more than one, the workers share
+# notifications through CLAIMS_DB: a SQLite file on a local disk of this host, or a Redis URL
+# (e.g. redis://claims-host:6379/0) when workers also run on other hosts (SQLite locks do not
+# work over network filesystems)
+WORKERS=1
+CLAIMS_DB="$SCRIPT_DIR/claims.sqlite"
 
-# Check if the script is already running
-if pgrep -f "$SCRIPT_PATH" > /dev/null; then
-    echo "Script is already running."
+# Activate virtual environment
+source "$VENV_ACTIVATE"
+
+if [ "$WORKERS" -le 1 ]; then
+    # Check if the script is already running
+    if pgrep -f "$SCRIPT_PATH" > /dev/null; then
+        echo "Script is already running."
+        exit 0
+    fi
+
+    # Run the script
+    cd "$SCRIPT_DIR"
+    python3 "$SCRIPT_PATH"
     exit 0
 fi
 
-# Activate virtual environment and run the script
-source "$VENV_ACTIVATE"
-cd "$SCRIPT_DIR"
-python3 "$SCRIPT_PATH"
-
+# Start every worker that is not running, each in its own directory (results/, logs, processed notifications)
+for i in $(seq 1 "$WORKERS"); do
+    if pgrep -f "$SCRIPT_PATH --worker $i " > /dev/null; then
+        echo "Worker $i is already running."
+        continue
+    fi
+    WORKER_DIR="$SCRIPT_DIR/workers/$i"
+    mkdir -p "$WORKER_DIR/results"
+    (cd "$WORKER_DIR" && nohup python3 "$SCRIPT_PATH" --worker "$i" --claims "$CLAIMS_DB" > /dev/null 2>&1 &)
+done
@@ -0,0 +1,284 @@
+from PIL import Image, ImageDraw, ImageFont
+import os
+import json
+import math
+import tools
+
+
+# Bundled bright-star / constellation-line / deep-sky catalog
+CATALOG_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "ressources", "skymap_catalog.json")
+# Rendered maps are kept here and reused for any field falling in the same sky cell
+CACHE_DIR = "results/skymap_cache"
+
+# Size of the spatial index cells in degrees
+INDEX_CELL_DEG = 10.0
+# Output image size in pixels
+MAP_SIZE = 800
+# Number of quantization steps across the map: a field center is snapped to
+# a grid of fov/QUANT_STEPS, so nearby fields share the same cached map
+QUANT_STEPS = 50
+
+# Field of view (degrees) of each zoom level as (multiplier of the field radius, min, max),
+# roughly matching the nova.astrometry.net sky_plot/zoom1 map. zoom2 (4-40 degree fields) would be
+# nearly empty with the bundled bright stars, it is left to nova (render() returns None for it)
+ZOOM_LEVELS = {
+    "zoom1": (12.0, 40.0, 120.0),
+}
+# Fewer catalog stars than this in the map: let the caller fall back to the nova map
+MIN_MAP_STARS = 5
+
+BACKGROUND_COLOR = (8, 12, 32)
+GRID_COLOR = (40, 50, 90)
+LINE_COLOR = (90, 140, 200)
+STAR_COLOR = (255, 255, 240)
+DSO_COLOR = (255, 170, 60)
+FIELD_COLOR = (255, 60, 60)
+LABEL_COLOR = (200, 200, 200)
+
+
+class skymap():
+    def __init__(self, logger, catalog_path=CATALOG_PATH, cache_dir=CACHE_DIR, store=None):
+        # logger: logger object for logging info and errors
+        # catalog_path: bundled JSON catalog (stars, constellation lines, deep-sky objects)
+        # cache_dir: directory where rendered maps are cached by quantized sky cell
+        # store: optional artifact_store tracking the cached maps so they are evicted with the other results
+        self.logger = logger
+        self.cache_dir = cache_dir
+        self.store = store
+        self.stars = []     # list of (name, ra, dec, mag)
+        self.segments = []  # list of (star index, star index) constellation line segments
+        self.dsos = []      # list of (name, ra, dec)
+        self.max_segment_deg = 0.0
+        self.load_catalog(catalog_path)
+        # Spatial indexes: (dec cell, ra cell) -> list of item indexes
+        self.star_index = self.build_index([(s[1], s[2]) for s in self.stars])
+        self.dso_index = self.build_index([(d[1], d[2]) for d in self.dsos])
+        self.segment_index = self.build_index([self.stars[a][1:3] for a, b in self.segments])
+
+    def load_catalog(self, catalog_path):
+        with open(catalog_path, 'r') as f:
+            catalog = json.load(f)
+
+        self.stars = [(name, ra, dec, mag) for name, ra, dec, mag in catalog.get("stars", [])]
+        star_ids = {s[0]: i for i, s in enumerate(self.stars)}
+
+        # Constellation figures are stored as polylines of star names, flatten them into segments
+        segments = set()
+        for polylines in catalog.get("lines", {}).values():
+            for polyline in polylines:
+                for a, b in zip(polyline, polyline[1:]):
+                    segment = tuple(sorted((star_ids[a], star_ids[b])))
+                    segments.add(segment)
+        self.segments = sorted(segments)
+        for a, b in self.segments:
+            length = angular_distance(self.stars[a][1], self.stars[a][2], self.stars[b][1], self.stars[b][2])
+            self.max_segment_deg = max(self.max_segment_deg, length)
+
+        self.dsos = [(name, ra, dec) for name, ra, dec in catalog.get("dso", [])]
+        self.logger.info(f"Loaded sky map catalog: {len(self.stars)} stars, {len(self.segments)} line segments, {len(self.dsos)} deep-sky objects")
+
+    def build_index(self, positions):
+        index = {}
+        for i, (ra, dec) in enumerate(positions):
+            index.setdefault(index_cell(ra, dec), []).append(i)
+        return index
+
+    def query_index(self, index, ra, dec, radius):
+        """Return the item indexes of all index cells overlapping the cone (ra, dec, radius)."""
+        dec_min = max(-90.0, dec - radius)
+        dec_max = min(90.0, dec + radius)
+        n_ra_cells = int(math.ceil(360.0 / INDEX_CELL_DEG))
+
+        # RA extent of the cone grows with declination and covers everything near the poles
+        max_abs_dec = max(abs(dec_min), abs(dec_max))
+        if max_abs_dec >= 89.0 or radius >= 90.0:
+            ra_cells = range(n_ra_cells)
+        else:
+            ra_half_width = radius / math.cos(math.radians(max_abs_dec))
+            if ra_half_width >= 180.0:
+                ra_cells = range(n_ra_cells)
+            else:
+                first = int(math.floor((ra - ra_half_width) / INDEX_CELL_DEG))
+                last = int(math.floor((ra + ra_half_width) / INDEX_CELL_DEG))
+                ra_cells = sorted({c % n_ra_cells for c in range(first, last + 1)})
+
+        first_dec = int(math.floor((dec_min + 90.0) / INDEX_CELL_DEG))
+        last_dec = int(math.floor((dec_max + 90.0) / INDEX_CELL_DEG))
+        found = []
+        for dec_cell in range(first_dec, last_dec + 1):
+            for ra_cell in ra_cells:
+                found.extend(index.get((dec_cell, ra_cell), []))
+        return found
+
+    def count_stars(self, ra, dec, radius):
+        """Number of catalog stars within radius degrees of (ra, dec)."""
+        return sum(1 for i in self.query_index(self.star_index, ra, dec, radius)
+                   if angular_distance(ra, dec, self.stars[i][1], self.stars[i][2]) <= radius)
+
+    def get_view(self, calibration, zoom):
+        """Return the quantized (ra, dec, fov, field radius) used to render and cache a zoom level."""
+        ra = calibration.get("ra", 0.0) % 360.0
+        dec = calibration.get("dec", 0.0)
+        radius = calibration.get("radius", 0.0)
+        multiplier, fov_min, fov_max = ZOOM_LEVELS[zoom]
+        fov = min(max(radius * multiplier, fov_min), fov_max)
+
+        # Snap the map center onto a grid of fov/QUANT_STEPS. RA steps are widened with
+        # declination so the cells keep roughly the same size on the sky.
+        step = fov / QUANT_STEPS
+        dec_q = round(dec / step) * step
+        ra_step = step / max(math.cos(math.radians(dec_q)), 0.05)
+        ra_q = (round(ra / ra_step) * ra_step) % 360.0
+        radius_q = round(radius / step) * step
+        return ra_q, dec_q, fov, radius_q
+
+    def get_cache_key(self, zoom, ra, dec, fov, radius):
+        return f"{zoom}_{ra:.3f}_{dec:+.3f}_{fov:.2f}_{radius:.3f}"
+
+    def get_cached(self, key):
+        if self.store is not None:
+            return self.store.get("skymap/" + key)
+        jpg_path = os.path.join(self.cache_dir, f"{key}.jpg")
+        return jpg_path if os.path.exists(jpg_path) else None
+
+    def render(self, calibration, zoom):
+        """
+        Render (or reuse from cache) a sky map around a calibration for the given zoom level.
+        Returns the path of a JPEG ready for upload, or None on failure.
+        """
+        if zoom not in ZOOM_LEVELS or not calibration or "ra" not in calibration or "dec" not in calibration:
+            return None
+        try:
+            ra, dec, fov, radius = self.get_view(calibration, zoom)
+            key = self.get_cache_key(zoom, ra, dec, fov, radius)
+            jpg_path = self.get_cached(key)
+            if jpg_path:
+                self.logger.info(f"Sky map {zoom} served from cache: {jpg_path}")
+                return jpg_path
+
+            if self.count_stars(ra, dec, fov / 2) < MIN_MAP_STARS:
+                self.logger.info(f"Too few catalog stars for a sky map {zoom} at RA {ra:.2f} Dec {dec:.2f} FOV {fov:.1f}")
+                return None
+
+            os.makedirs(self.cache_dir, exist_ok=True)
+            png_path = os.path.join(self.cache_dir, f"{key}.png")
+            img = self.draw_map(ra, dec, fov, radius)
+            img.save(png_path, "PNG")
+            self.logger.info(f"Rendered sky map {zoom} at RA {ra:.2f} Dec {dec:.2f} FOV {fov:.1f}: {png_path}")
+        except Exception as e:
+            self.logger.error(f"Failed to render sky map {zoom}: {e}")
+            return None
+
+        jpg_path = tools.convert_image_to_jpg(self.logger, png_path)
+        if jpg_path:
+            jpg_path = tools.ensure_image_size_under_limit(self.logger, jpg_path)
+        if jpg_path:
+            tools.remove_source_png(self.logger, png_path)
+        if jpg_path and self.store is not None:
+            self.store.put("skymap/" + key, jpg_path)
+        return jpg_path
+
+    def draw_map(self, ra0, dec0, fov, field_radius):
+        img = Image.new("RGB", (MAP_SIZE, MAP_SIZE), BACKGROUND_COLOR)
+        draw = ImageDraw.Draw(img)
+        font = ImageFont.load_default()
+
+        # Gnomonic (tangent plane) projection, north up and east to the left
+        scale = (MAP_SIZE / 2) / math.tan(math.radians(fov / 2))
+        center = MAP_SIZE / 2
+
+        def project(ra, dec):
+            xy = gnomonic(ra0, dec0, ra, dec)
+            if xy is None:
+                return None
+            return center - xy[0] * scale, center - xy[1] * scale
+
+        # Only look at catalog entries inside the circle enclosing the map
+        view_radius = min(fov / math.sqrt(2) + 1.0, 90.0)
+
+        self.draw_grid(draw, project, ra0, dec0, fov)
+
+        for i in self.query_index(self.segment_index, ra0, dec0, min(view_radius + self.max_segment_deg, 180.0)):
+            a, b = self.segments[i]
+            pa = project(self.stars[a][1], self.stars[a][2])
+            pb = project(self.stars[b][1], self.stars[b][2])
+            if pa and pb:
+                draw.line([pa, pb], fill=LINE_COLOR, width=2)
+
+        for i in self.query_index(self.dso_index, ra0, dec0, view_radius):
+            name, ra, dec = self.dsos[i]
+            p = project(ra, dec)
+            if p and on_canvas(p):
+                draw.ellipse([p[0] - 6, p[1] - 4, p[0] + 6, p[1] + 4], outline=DSO_COLOR, width=2)
+                draw.text((p[0] + 8, p[1] - 6), name, fill=DSO_COLOR, font=font)
+
+        # Brighter stars are drawn larger, labels only for the ones likely to be recognized
+        label_mag = 2.0 if fov > 30 else 4.0
+        for i in self.query_index(self.star_index, ra0, dec0, view_radius):
+            name, ra, dec, mag = self.stars[i]
+            p = project(ra, dec)
+            if p and on_canvas(p):
+                r = max(1.5, 6.0 - mag * 1.2)
+                draw.ellipse([p[0] - r, p[1] - r, p[0] + r, p[1] + r], fill=STAR_COLOR)
+                if mag <= label_mag:
+                    draw.text((p[0] + r + 3, p[1] - 5), name, fill=LABEL_COLOR, font=font)
+
+        # Outline of the solved field
+        r = max(3.0, math.tan(math.radians(field_radius)) * scale)
+        draw.ellipse([center - r, center - r, center + r, center + r], outline=FIELD_COLOR, width=3)
+
+        draw.text((10, MAP_SIZE - 20), f"RA {ra0:.1f}°  Dec {dec0:+.1f}°  FOV {fov:.0f}°", fill=LABEL_COLOR, font=font)
+        return img
+
+    def draw_grid(self, draw, project, ra0, dec0, fov):
+        # RA/Dec graticule, spacing adapted to the field of view
+        spacing = 30.0 if fov > 60 else 10.0 if fov > 15 else 2.0
+        samples = 60
+        for k in range(int(180 / spacing) + 1):
+            dec = -90.0 + k * spacing
+            points = [project(j * 360.0 / samples, dec) for j in range(samples + 1)]
+            draw_polyline(draw, points, GRID_COLOR)
+        for k in range(int(360 / spacing)):
+            ra = k * spacing
+            points = [project(ra, -90.0 + j * 180.0 / samples) for j in range(samples + 1)]
+            draw_polyline(draw, points, GRID_COLOR)
+
+
+def index_cell(ra, dec):
+    n_ra_cells = int(math.ceil(360.0 / INDEX_CELL_DEG))
+    dec_cell = int(math.floor((min(dec, 89.999) + 90.0) / INDEX_CELL_DEG))
+    ra_cell = int(math.floor((ra % 360.0) / INDEX_CELL_DEG)) % n_ra_cells
+    return dec_cell, ra_cell
+
+
+def angular_distance(ra1, dec1, ra2, dec2):
+    ra1, dec1, ra2, dec2 = map(math.radians, (ra1, dec1, ra2, dec2))
+    cos_d = math.sin(dec1) * math.sin(dec2) + math.cos(dec1) * math.cos(dec2) * math.cos(ra1 - ra2)
+    return math.degrees(math.acos(min(1.0, max(-1.0, cos_d))))
+
+
+def gnomonic(ra0, dec0, ra, dec):
+    """Project (ra, dec) on the plane tangent at (ra0, dec0). Returns None for the far hemisphere."""
+    ra0, dec0, ra, dec = map(math.radians, (ra0, dec0, ra, dec))
+    cos_c = math.sin(dec0) * math.sin(dec) + math.cos(dec0) * math.cos(dec) * math.cos(ra - ra0)
+    if cos_c <= 0.05:
+        return None
+    x = math.cos(dec) * math.sin(ra - ra0) / cos_c
+    y = (math.cos(dec0) * math.sin(dec) - math.sin(dec0) * math.cos(dec) * math.cos(ra - ra0)) / cos_c
+    return x, y
+
+
+def on_canvas(p, margin=20):
+    return -margin <= p[0] <= MAP_SIZE + margin and -margin <= p[1] <= MAP_SIZE + margin
+
+
+def draw_polyline(draw, points, color):
+    # Break the line wherever a point falls behind the tangent plane
+    run = []
+    for p in points + [None]:
+        if p is not None:
+            run.append(p)
+            continue
+        if len(run) > 1:
+            draw.line(run, fill=color, width=1)
+        run = []
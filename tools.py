@@ -1,9 +1,12 @@
 from PIL import Image, ImageDraw, ImageFont
 import os
+import hashlib
 
 
 # Maximum desired file size in bytes (900KB)
 MAX_IMAGE_SIZE = 900 * 1024
+# Font of the table image, next to the code (workers run from their own working directory)
+FONT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "arial.ttf")
 
 def convert_image_to_jpg(logger,png_path):
     if png_path and os.path.exists(png_path):
@@ -44,6 +47,16 @@ def ensure_image_size_under_limit(logger,jpg_path, max_size=MAX_IMAGE_SIZE):
     return jpg_path
 
 
+def remove_source_png(logger, png_path):
+    # Once converted, only the JPG is uploaded or reused: don't let the PNG take space in results/
+    try:
+        os.remove(png_path)
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        logger.error(f"Failed to remove {png_path}: {e}")
+
+
 
 def convert_image_to_jpg(logger,png_path):
     if png_path and os.path.exists(png_path):
@@ -86,7 +99,7 @@ def generate_text(results):
     return reply_text,reply_alt_text
 
 
-def create_table_image(logger,results, max_size=MAX_IMAGE_SIZE):
+def create_table_image(logger,results, max_size=MAX_IMAGE_SIZE, store=None):
     cal = results.get("calibration", {})
     ra = cal.get("ra", 0.0)
     dec = cal.get("dec", 0.0)
@@ -109,7 +122,16 @@ def create_table_image(logger,results, max_size=MAX_IMAGE_SIZE):
     if truncated:
         lines.append(f"Total Objects: {len(objects_in_field)}")
 
-    font_path = "arial.ttf"
+    # The table only depends on its text: reuse a stored rendering of identical content
+    key = None
+    if store is not None:
+        key = "table/" + hashlib.sha1("\n".join(lines).encode("utf-8")).hexdigest()
+        table_jpg = store.get(key)
+        if table_jpg:
+            logger.info(f"Reusing stored table image {table_jpg}")
+            return table_jpg
+
+    font_path = FONT_PATH
     if not os.path.exists(font_path):
         font = ImageFont.load_default()
     else:
@@ -148,10 +170,17 @@ def create_table_image(logger,results, max_size=MAX_IMAGE_SIZE):
         draw.text((x, y), line, fill="black", font=font)
         y += h + 10
 
-    table_png = "results/table_data.png"
+    if store is not None:
+        table_png = store.path(f"table_{key[len('table/'):]}.png")
+    else:
+        table_png = "results/table_data.png"
     img.save(table_png, "PNG")
 
     table_jpg = convert_image_to_jpg(logger,table_png)
     if table_jpg:
         table_jpg = ensure_image_size_under_limit(logger,table_jpg, MAX_IMAGE_SIZE)
+    if table_jpg:
+        remove_source_png(logger, table_png)
+    if table_jpg and store is not None:
+        store.put(key, table_jpg)
     return table_jpg
\ No newline at end of file
@@ -0,0 +1,471 @@
+"""
+Capture and offline replay of the bot's network traffic.
+
+Capture (see TRACE_FILENAME in bot.py) records every Bluesky client call (notification pages,
+post threads, blob uploads, posts) and every HTTP response from nova.astrometry.net and the
+Bluesky CDN, with their timings, as JSON lines. Binary bodies (images) are stored next to the
+trace in '<trace>.blobs/'.
+
+Replay feeds a trace into bot.py's pipeline with the network served from the trace and reports
+queueing delay and throughput. Recorded network waits are replayed N times faster than real time
+but count at their full length in the virtual clock, local work counts at its measured duration,
+so the report does not depend on N:
+
+    python traffic.py trace.jsonl --speed 20 --report replay_report.json
+"""
+import os
+import json
+import time
+import shutil
+import hashlib
+import logging
+import argparse
+import tempfile
+import statistics
+import threading
+import requests
+from requests.structures import CaseInsensitiveDict
+from requests.cookies import RequestsCookieJar
+
+
+# --- capture ---
+
+class trace_recorder():
+    def __init__(self, path):
+        # path: JSON-lines trace file, binary bodies are written to '<path>.blobs/'
+        self.path = path
+        self.blobs_dir = path + ".blobs"
+        os.makedirs(self.blobs_dir, exist_ok=True)
+        self.file = open(path, 'w', encoding="utf-8")
+        self.lock = threading.Lock()
+        self.start = time.monotonic()
+
+    def offset(self):
+        """Seconds since the start of the capture."""
+        return time.monotonic() - self.start
+
+    def write(self, entry):
+        with self.lock:
+            self.file.write(json.dumps(entry, separators=(",", ":"), default=str, ensure_ascii=False) + "\n")
+            self.file.flush()
+
+    def save_blob(self, data):
+        digest = hashlib.sha1(data).hexdigest()
+        blob_path = os.path.join(self.blobs_dir, digest)
+        if not os.path.exists(blob_path):
+            with open(blob_path, 'wb') as f:
+                f.write(data)
+        return digest
+
+
+def to_json(value):
+    """Convert atproto models (pydantic) and call arguments to plain JSON values."""
+    if hasattr(value, "model_dump"):
+        return value.model_dump(mode="json", by_alias=True)
+    if isinstance(value, (bytes, bytearray)):
+        return {"bytes": len(value)}
+    if isinstance(value, dict):
+        return {k: to_json(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [to_json(v) for v in value]
+    return value
+
+
+class traced_client():
+    """Proxy around the atproto Client recording every API call, e.g. 'app.bsky.feed.get_post_thread'."""
+
+    def __init__(self, target, recorder, path=""):
+        self._target = target
+        self._recorder = recorder
+        self._path = path
+
+    def __getattr__(self, name):
+        value = getattr(self._target, name)
+        # client.app, client.app.bsky, ... are namespace objects: keep proxying down to the method
+        if type(value).__name__.endswith("Namespace"):
+            return traced_client(value, self._recorder, self._path + name + ".")
+        if callable(value):
+            return self._wrap(self._path + name, value)
+        return value
+
+    def _wrap(self, name, func):
+        def call(*args, **kwargs):
+            entry = {"kind": "bluesky", "name": name, "t": self._recorder.offset(), "args": to_json(args)}
+            start = time.monotonic()
+            try:
+                response = func(*args, **kwargs)
+            except Exception as e:
+                entry.update({"duration": time.monotonic() - start, "error": repr(e)})
+                self._recorder.write(entry)
+                raise
+            entry.update({"duration": time.monotonic() - start, "response": to_json(response)})
+            self._recorder.write(entry)
+            return response
+        return call
+
+
+class traced_http():
+    """Proxy around a requests.Session recording every response (status, content type, body, timing)."""
+
+    def __init__(self, session, recorder, name):
+        self.session = session
+        self.recorder = recorder
+        self.name = name  # 'nova' or 'bluesky', for reading the trace
+
+    def __getattr__(self, name):
+        # cookies, headers, mount, ... go straight to the session
+        return getattr(self.session, name)
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+    def request(self, method, url, **kwargs):
+        entry = {"kind": "http", "api": self.name, "method": method, "url": url, "t": self.recorder.offset()}
+        if kwargs.get("files"):
+            entry["upload"] = upload_key(kwargs["files"])
+        start = time.monotonic()
+        try:
+            response = self.session.request(method, url, **kwargs)
+            content = response.content  # read streamed bodies now, requests serves them again from memory
+        except requests.exceptions.RequestException as e:
+            entry.update({"duration": time.monotonic() - start, "error": repr(e)})
+            self.recorder.write(entry)
+            raise
+        content_type = response.headers.get("Content-Type", "")
+        entry.update({"duration": time.monotonic() - start, "status": response.status_code, "content_type": content_type})
+        if content_type.startswith(("application/json", "text/")):
+            entry["text"] = response.text
+        else:
+            entry["blob"] = self.recorder.save_blob(content)
+        self.recorder.write(entry)
+        return response
+
+
+def upload_key(files):
+    """SHA-1 of the file parts of a multipart upload, to match replayed uploads with the recorded ones."""
+    digest = hashlib.sha1()
+    for name, value in sorted(files.items()):
+        if hasattr(value, "read"):
+            position = value.tell()
+            digest.update(value.read())
+            value.seek(position)
+    return digest.hexdigest()
+
+
+def capture(logger, path, bs, astro):
+    """Start recording the traffic of a bluesky and an astrometry instance to a trace file."""
+    recorder = trace_recorder(path)
+    recorder.write({"kind": "meta", "t": 0.0, "botname": bs.botname, "did": bs.client.me.did})
+    bs.client = traced_client(bs.client, recorder)
+    bs.http = traced_http(bs.http, recorder, "bluesky")
+    astro.http = traced_http(astro.http, recorder, "nova")
+    logger.info(f"Recording traffic trace to {path}")
+    return recorder
+
+
+# --- replay ---
+
+class record(dict):
+    """Recorded payload allowing both item and attribute access, like the atproto models."""
+
+    # atproto model attribute names that differ from the JSON keys
+    ALIASES = {"link": "$link", "mime_type": "mimeType"}
+
+    def __getattr__(self, name):
+        try:
+            return self[self.ALIASES.get(name, name)]
+        except KeyError:
+            raise AttributeError(name)
+
+
+def to_record(value):
+    if isinstance(value, dict):
+        return record({k: to_record(v) for k, v in value.items()})
+    if isinstance(value, list):
+        return [to_record(v) for v in value]
+    return value
+
+
+class replay_clock():
+    """
+    Stand-in for the time module, starting from 0. Sleeps (recorded network waits, polling) advance
+    the virtual time by their full length while taking 1/speed of it in real time; the time spent
+    outside sleeps (triage, rendering, JPEG conversion) counts as measured.
+    """
+
+    def __init__(self, speed):
+        self.speed = speed
+        self.real_start = time.monotonic()
+        self.virtual_sleep = 0.0  # virtual seconds spent in sleep()
+        self.real_sleep = 0.0     # real seconds these sleeps took
+
+    def time(self):
+        return time.monotonic() - self.real_start - self.real_sleep + self.virtual_sleep
+
+    def monotonic(self):
+        return self.time()
+
+    def sleep(self, seconds):
+        if seconds > 0:
+            start = time.monotonic()
+            time.sleep(seconds / self.speed)
+            self.real_sleep += time.monotonic() - start
+            self.virtual_sleep += seconds
+
+
+class trace():
+    def __init__(self, path):
+        self.path = path
+        self.blobs_dir = path + ".blobs"
+        self.meta = {}
+        self.pages = []       # (t, response) of every list_notifications call
+        self.threads = {}     # uri -> latest get_post_thread entry
+        self.calls = {}       # call name -> entries in order (upload_blob, create_record, ...)
+        self.http = {}        # (method, url, upload file hash or None) -> entries in order
+        self.first_seen = {}  # notification uri -> t of the first page listing it
+        self.unfetched = set()  # mentions listed but whose thread was never fetched (capture stopped in a burst)
+        self.end = 0.0
+        with open(path, 'r', encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    self.add(json.loads(line))
+        # Without their thread these mentions can't go through the pipeline: leave them out of the replay
+        for uri in list(self.first_seen):
+            if "response" not in self.threads.get(uri, {}):
+                self.unfetched.add(uri)
+                del self.first_seen[uri]
+
+    def add(self, entry):
+        self.end = max(self.end, entry.get("t", 0.0) + entry.get("duration", 0.0))
+        if entry["kind"] == "meta":
+            self.meta = entry
+        elif entry["kind"] == "http":
+            self.http.setdefault((entry["method"], entry["url"], entry.get("upload")), []).append(entry)
+        elif entry["name"].endswith("list_notifications"):
+            if "response" in entry:
+                self.pages.append((entry["t"], entry["response"]))
+                for notification in entry["response"].get("notifications", []):
+                    if notification.get("reason") == "mention":
+                        self.first_seen.setdefault(notification["uri"], entry["t"])
+        elif entry["name"].endswith("get_post_thread"):
+            self.threads[entry["args"][0]["uri"]] = entry
+        else:
+            self.calls.setdefault(entry["name"].rsplit(".", 1)[-1], []).append(entry)
+
+    def read_blob(self, digest):
+        with open(os.path.join(self.blobs_dir, digest), 'rb') as f:
+            return f.read()
+
+
+class replay_report():
+    def __init__(self, trace, clock):
+        self.trace = trace
+        self.clock = clock
+        self.replies = {}  # notification uri -> virtual time of the bot's reply
+        self.real_start = time.monotonic()
+
+    def record_post(self, post_record):
+        parent_uri = post_record.get("reply", {}).get("parent", {}).get("uri")
+        if parent_uri:
+            self.replies.setdefault(parent_uri, self.clock.time())
+
+    def summary(self):
+        delays = sorted(self.replies[uri] - t for uri, t in self.trace.first_seen.items() if uri in self.replies)
+        virtual_duration = self.clock.time()
+        summary = {
+            "trace": self.trace.path,
+            "speed": self.clock.speed,
+            "mentions": len(self.trace.first_seen),
+            "unreplayable_mentions": len(self.trace.unfetched),
+            "replied": len(delays),
+            "virtual_duration_s": virtual_duration,
+            "real_duration_s": time.monotonic() - self.real_start,
+            "throughput_per_hour": len(delays) / virtual_duration * 3600 if virtual_duration > 0 else 0.0,
+        }
+        if delays:
+            summary.update({
+                "queue_delay_mean_s": statistics.mean(delays),
+                "queue_delay_p50_s": delays[len(delays) // 2],
+                "queue_delay_p95_s": delays[min(len(delays) - 1, int(len(delays) * 0.95))],
+                "queue_delay_max_s": delays[-1],
+            })
+        return summary
+
+
+class replay_client():
+    """Serves the Bluesky client calls used by bluesky.py from a trace."""
+
+    def __init__(self, trace, clock, report):
+        self.trace = trace
+        self.clock = clock
+        self.report = report
+        self.pending = {name: list(entries) for name, entries in trace.calls.items()}
+        self.me = record({"did": trace.meta.get("did", "did:plc:replay")})
+        # client.app.bsky.notification.list_notifications(), client.com.atproto.repo.create_record(), ...
+        self.app = self.bsky = self.notification = self.feed = self
+        self.com = self.atproto = self.repo = self
+
+    def wait_like(self, name):
+        # Take as long as the next recorded call of the same kind
+        entries = self.pending.get(name)
+        if entries:
+            entry = entries.pop(0) if len(entries) > 1 else entries[0]
+            self.clock.sleep(entry.get("duration", 0.0))
+
+    def list_notifications(self, *args, **kwargs):
+        # Latest page recorded before the current (virtual) time
+        now = self.clock.time()
+        page = {"notifications": []}
+        for t, response in self.trace.pages:
+            if t > now:
+                break
+            page = response
+        # Mentions whose thread is not in the trace are not served
+        notifications = [n for n in page.get("notifications", []) if n.get("uri") not in self.trace.unfetched]
+        return to_record({**page, "notifications": notifications})
+
+    def get_post_thread(self, params):
+        entry = self.trace.threads.get(params["uri"])
+        if entry is None or "response" not in entry:
+            raise Exception(f"Post thread not found in trace: {params['uri']}")
+        self.clock.sleep(entry.get("duration", 0.0))
+        return to_record(entry["response"])
+
+    def upload_blob(self, data):
+        self.wait_like("upload_blob")
+        return to_record({"blob": {"$type": "blob", "ref": {"$link": hashlib.sha1(data).hexdigest()}, "mimeType": "image/jpeg", "size": len(data)}})
+
+    def create_record(self, data):
+        self.wait_like("create_record")
+        if data.get("collection") == "app.bsky.feed.post":
+            self.report.record_post(data.get("record", {}))
+        return to_record({"uri": f"at://{self.me.did}/{data.get('collection')}/replay", "cid": "replay"})
+
+
+class replayed_response():
+    def __init__(self, status_code, content_type, content):
+        self.status_code = status_code
+        self.headers = CaseInsensitiveDict({"Content-Type": content_type})
+        self.content = content
+
+    @property
+    def text(self):
+        return self.content.decode("utf-8", errors="replace")
+
+    def json(self):
+        return json.loads(self.content)
+
+    def iter_content(self, chunk_size=1):
+        for i in range(0, len(self.content), chunk_size):
+            yield self.content[i:i + chunk_size]
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.exceptions.HTTPError(f"{self.status_code} replayed error")
+
+
+class replay_http():
+    """
+    Serves requests.Session get/post calls from a trace, in recorded order for each (method, url).
+    Uploads are matched by the hash of the uploaded file, so that skipping one (triage reject, ...)
+    does not shift the submission ids of the following ones.
+    """
+
+    def __init__(self, trace, clock):
+        self.trace = trace
+        self.clock = clock
+        self.pending = {key: list(entries) for key, entries in trace.http.items()}
+        self.headers = {}
+        self.cookies = RequestsCookieJar()
+
+    def mount(self, prefix, adapter):
+        pass
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+    def request(self, method, url, **kwargs):
+        if kwargs.get("files"):
+            # Traces recorded before uploads were keyed fall back to the recorded order
+            entries = self.pending.get((method, url, upload_key(kwargs["files"]))) or self.pending.get((method, url, None))
+        else:
+            entries = self.pending.get((method, url, None))
+        if not entries:
+            return replayed_response(404, "text/plain", b"not in trace")
+        # Polled URLs (job status, ...) replay their recorded sequence, then stick to the last answer
+        entry = entries.pop(0) if len(entries) > 1 else entries[0]
+        self.clock.sleep(entry.get("duration", 0.0))
+        if "error" in entry:
+            raise requests.exceptions.ConnectionError(entry["error"])
+        if "text" in entry:
+            content = entry["text"].encode("utf-8")
+        else:
+            content = self.trace.read_blob(entry["blob"])
+        return replayed_response(entry["status"], entry.get("content_type", ""), content)
+
+
+def replay(logger, trace_path, speed, workdir=None):
+    """Run bot.py's pipeline over a trace at 'speed' times real time and return the report summary."""
+    import bot
+    import astrometry as astrometry_module
+    from bluesky import bluesky
+    from artifacts import artifact_store
+    from triage import image_triage
+
+    tr = trace(os.path.abspath(trace_path))
+    clock = replay_clock(speed)
+    report = replay_report(tr, clock)
+
+    own_workdir = workdir is None
+    workdir = workdir or tempfile.mkdtemp(prefix="replay_")
+    os.makedirs(workdir, exist_ok=True)
+    cwd = os.getcwd()
+    saved_time = (bot.time, astrometry_module.time)
+    try:
+        # Everything the pipeline writes (results/, processed notifications) stays in the work directory
+        os.chdir(workdir)
+        os.makedirs("results", exist_ok=True)
+        bot.time = astrometry_module.time = clock
+
+        store = artifact_store(logger)
+        bs = bluesky(logger, tr.meta.get("botname", ""), None, None, "processed_notifications.json", client=replay_client(tr, clock, report))
+        bs.http = replay_http(tr, clock)
+        astro = astrometry_module.astrometry(logger, "replay", store)
+        astro.http = replay_http(tr, clock)
+
+        def stop():
+            return clock.time() > tr.end and all(uri in bs.processed_notifications for uri in tr.first_seen)
+
+        logger.info(f"Replaying {trace_path} at {speed}x ({tr.end:.0f}s of traffic, {len(tr.first_seen)} mentions, {len(tr.unfetched)} not replayable)")
+        bot.run(logger, bs, astro, store, stop, triage=image_triage(logger))
+    finally:
+        bot.time, astrometry_module.time = saved_time
+        os.chdir(cwd)
+        if own_workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+    return report.summary()
+
+
+if __name__ == "__main__":
+    import botlog
+
+    parser = argparse.ArgumentParser(description="Replay a captured traffic trace through the bot pipeline.")
+    parser.add_argument("trace", help="JSON-lines trace recorded with TRACE_FILENAME in bot.py")
+    parser.add_argument("--speed", type=float, default=10.0, help="replay recorded network waits this many times faster (does not change the report)")
+    parser.add_argument("--workdir", help="keep the generated files in this directory (default: temporary)")
+    parser.add_argument("--report", help="also write the report as JSON to this file")
+    parser.add_argument("--log", default="replay.log", help="log file of the replayed bot")
+    args = parser.parse_args()
+
+    botlog.setup_logging(args.log, level=logging.INFO, queued=True)
+    summary = replay(logging.getLogger("replay"), args.trace, args.speed, args.workdir)
+    print(json.dumps(summary, indent=2))
+    if args.report:
+        with open(args.report, 'w') as f:
+            json.dump(summary, f, indent=2)
@@ -0,0 +1,288 @@
+from PIL import Image, UnidentifiedImageError
+from collections import OrderedDict
+import numpy as np
+import os
+import json
+import hashlib
+
+
+# Cache of earlier verdicts, keyed by perceptual hash of the image (JSON lines, appended to)
+CACHE_PATH = "triage_cache.jsonl"
+CACHE_MAX_ENTRIES = 10000
+# Images whose hash differs by at most this many bits from a cached rejected image are rejected too
+NEAR_DUPLICATE_BITS = 4
+# Hashes with fewer set (or unset) bits than this carry too little structure to identify an image:
+# dark star fields and blank frames all hash close to zero, so they are not cached by hash
+MIN_HASH_BITS = 8
+
+# Longest side of the downsampled image analyzed
+MAX_SIDE = 512
+# Size of the blocks used to estimate the background
+BACKGROUND_BLOCK = 16
+# Detection threshold of point sources above the background, in background sigmas
+DETECTION_SIGMA = 5.0
+# A peak counts as a star when its radius-1 neighbours are balanced: the spread between the opposite
+# neighbour pairs (horizontal, vertical, diagonals) is at most this fraction of the peak. Glyph strokes
+# and edges of graphics are bright along one direction only
+ROUND_MAX_ELONGATION = 0.4
+# Pixel values counted as saturated (8 bits)
+SATURATION_LEVEL = 250
+
+# Rejection thresholds
+MIN_SOURCES = 3             # fewer point sources than this cannot be solved
+MAX_SATURATED = 0.5         # fraction of saturated pixels
+BLANK_RANGE = 4.0           # spread between the 0.5th and 99.5th percentiles below this is a blank frame
+FLAT_FRACTION = 0.4         # fraction of pixels sharing one exact value (screenshots, graphics)
+FLAT_MIN_VALUE = 40         # mid-tone flat areas (FLAT_MIN_VALUE..SATURATION_LEVEL) are always graphics, dark or
+                            # clipped ones can be a clipped sky background or overexposure: judged by source shapes
+MIN_ROUND_FRACTION = 0.5    # fewer round peaks than this among all peaks of a flat image: text or graphics
+# Thresholds below which the image is kept but given a shorter solve time
+FEW_SOURCES = 15
+BRIGHT_BACKGROUND = 150.0   # median pixel value of daylight / white background pictures
+
+OK = "ok"
+DOUBTFUL = "doubtful"
+REJECT = "reject"
+
+
+class image_triage():
+    def __init__(self, logger, cache_path=CACHE_PATH):
+        # logger: logger object for logging info and errors
+        # cache_path: JSON-lines file keeping the verdicts of earlier images, appended to (None: in memory only)
+        self.logger = logger
+        self.cache_path = cache_path
+        self.cache = OrderedDict()  # perceptual hash (hex) or 'sha1:' file key -> [verdict, reason], least recently used first
+        self.bands = {}             # (band number, band bits) -> perceptual hashes of rejected images with these bits
+        self.journal_lines = 0      # lines in the cache file, rewritten when it grows past twice the cache size
+        self.load_cache()
+
+    def load_cache(self):
+        if self.cache_path and os.path.exists(self.cache_path):
+            try:
+                with open(self.cache_path, 'r') as f:
+                    for line in f:
+                        if line.strip():
+                            key, verdict, reason = json.loads(line)
+                            self.store(key, verdict, reason)
+                            self.journal_lines += 1
+            except Exception as e:
+                self.logger.error(f"Failed to load triage cache {self.cache_path}: {e}")
+                # Start a clean file from what could be read, later appends would not be readable either
+                self.save_cache()
+
+    def save_cache(self):
+        # Rewrite the whole file from memory, dropping evicted and overwritten entries
+        if self.cache_path:
+            with open(self.cache_path, 'w') as f:
+                for key, (verdict, reason) in self.cache.items():
+                    f.write(json.dumps([key, verdict, reason]) + "\n")
+            self.journal_lines = len(self.cache)
+
+    def band_keys(self, phash):
+        # Split the 64 bits in NEAR_DUPLICATE_BITS + 1 bands: hashes differing by at most
+        # NEAR_DUPLICATE_BITS bits have at least one band in common
+        value = int(phash, 16)
+        count = NEAR_DUPLICATE_BITS + 1
+        bounds = [64 * i // count for i in range(count + 1)]
+        return [(i, (value >> bounds[i]) & ((1 << (bounds[i + 1] - bounds[i])) - 1)) for i in range(count)]
+
+    def index(self, key, verdict, add):
+        if verdict != REJECT or key.startswith("sha1:"):
+            return
+        for band in self.band_keys(key):
+            if add:
+                self.bands.setdefault(band, set()).add(key)
+            else:
+                keys = self.bands.get(band)
+                if keys is not None:
+                    keys.discard(key)
+                    if not keys:
+                        del self.bands[band]
+
+    def store(self, key, verdict, reason):
+        # In memory only
+        previous = self.cache.pop(key, None)
+        if previous is not None:
+            self.index(key, previous[0], add=False)
+        self.cache[key] = [verdict, reason]
+        self.index(key, verdict, add=True)
+        while len(self.cache) > CACHE_MAX_ENTRIES:
+            old_key, (old_verdict, _) = self.cache.popitem(last=False)
+            self.index(old_key, old_verdict, add=False)
+
+    def remember(self, keys, verdict, reason):
+        for key in keys:
+            self.store(key, verdict, reason)
+        if not self.cache_path:
+            return
+        # Append only; compact once the file holds twice as many lines as the cache
+        if self.journal_lines + len(keys) > 2 * CACHE_MAX_ENTRIES:
+            self.save_cache()
+            return
+        with open(self.cache_path, 'a') as f:
+            f.write("".join(json.dumps([key, verdict, reason]) + "\n" for key in keys))
+        self.journal_lines += len(keys)
+
+    def lookup(self, key):
+        cached = self.cache.get(key)
+        if cached is not None:
+            self.cache.move_to_end(key)
+        return cached
+
+    def lookup_similar(self, phash):
+        # Slightly re-encoded or resized copies of known junk have nearly the same hash
+        value = int(phash, 16)
+        for band in self.band_keys(phash):
+            for other in self.bands.get(band, ()):
+                if bin(value ^ int(other, 16)).count("1") <= NEAR_DUPLICATE_BITS:
+                    return self.cache[other]
+        return None
+
+    def check(self, image_path):
+        """
+        Cheap local check of an image before sending it to astrometry.net.
+        Returns (verdict, reason): REJECT (reply right away with the reason), DOUBTFUL (solve with
+        a shorter time budget) or OK.
+        """
+        try:
+            # Exact repeats (the same file posted again) are answered before decoding anything
+            with open(image_path, 'rb') as f:
+                file_key = "sha1:" + hashlib.sha1(f.read()).hexdigest()
+            cached = self.lookup(file_key)
+            if cached is not None:
+                self.logger.info(f"Triage verdict for {image_path} from cache: {cached[0]} ({cached[1]})")
+                return cached[0], cached[1]
+
+            try:
+                gray = load_downsampled(image_path)
+            except (UnidentifiedImageError, OSError) as e:
+                self.logger.info(f"Triage rejected {image_path}: unreadable image ({e})")
+                self.remember([file_key], REJECT, "the file is not a readable image")
+                return REJECT, "the file is not a readable image"
+
+            phash = dhash(gray)
+            informative = MIN_HASH_BITS <= bin(int(phash, 16)).count("1") <= 64 - MIN_HASH_BITS
+            if informative:
+                cached = self.lookup(phash) or self.lookup_similar(phash)
+                if cached is not None:
+                    self.logger.info(f"Triage verdict for {image_path} from cache: {cached[0]} ({cached[1]})")
+                    self.remember([file_key], cached[0], cached[1])
+                    return cached[0], cached[1]
+
+            stats = measure(np.asarray(gray, dtype=np.float32))
+            verdict, reason = judge(stats)
+            self.logger.info(f"Triage verdict for {image_path}: {verdict} ({reason})", extra={"fields": {"phash": phash, **stats}})
+            self.remember([phash, file_key] if informative else [file_key], verdict, reason)
+            return verdict, reason
+        except Exception as e:
+            # Never block a solve because of a triage bug
+            self.logger.error(f"Triage failed for {image_path}: {e}")
+            return OK, "triage failed"
+
+
+def load_downsampled(image_path):
+    with Image.open(image_path) as img:
+        # For JPEGs, let the decoder skip the full resolution (DCT scaling)
+        img.draft("L", (MAX_SIDE, MAX_SIDE))
+        gray = img.convert("L")
+    gray.thumbnail((MAX_SIDE, MAX_SIDE))
+    return gray
+
+
+def dhash(gray):
+    """64-bit difference hash of a grayscale PIL image, as a hex string."""
+    small = np.asarray(gray.resize((9, 8), Image.BILINEAR), dtype=np.int16)
+    bits = (small[:, 1:] > small[:, :-1]).flatten()
+    return f"{int(''.join('1' if b else '0' for b in bits), 2):016x}"
+
+
+def block_background(data, block=BACKGROUND_BLOCK):
+    """Background map from the median of block x block tiles, expanded back to the image size."""
+    h, w = data.shape
+    bh, bw = max(1, h // block), max(1, w // block)
+    tiles = data[:bh * block, :bw * block].reshape(bh, block, bw, block)
+    medians = np.median(tiles.swapaxes(1, 2).reshape(bh, bw, -1), axis=2)
+    background = np.repeat(np.repeat(medians, block, axis=0), block, axis=1)
+    return np.pad(background, ((0, h - background.shape[0]), (0, w - background.shape[1])), mode="edge")
+
+
+def count_point_sources(residual, threshold):
+    """
+    Count compact local maxima above threshold, ignoring extended bright areas.
+    Returns (round, peaks): the round ones (stars) and all of them (including glyph strokes, corners).
+    """
+    r = 3  # radius of the ring a point source must fall off at
+    h, w = residual.shape
+    if h <= 2 * r or w <= 2 * r:
+        return 0, 0
+    core = residual[r:h - r, r:w - r]
+
+    def shifted(dy, dx):
+        return residual[r + dy:h - r + dy, r + dx:w - r + dx]
+
+    peaks = core > threshold
+    # Local maximum of the 3x3 neighbourhood; strict on one side so flat tops count once
+    for dy, dx in ((-1, -1), (-1, 0), (-1, 1), (0, -1)):
+        peaks &= core > shifted(dy, dx)
+    for dy, dx in ((0, 1), (1, -1), (1, 0), (1, 1)):
+        peaks &= core >= shifted(dy, dx)
+    # Point-like: the ring at radius r is at most half the peak height
+    ring = sum(shifted(dy, dx) for dy, dx in ((-r, 0), (r, 0), (0, -r), (0, r), (-2, -2), (-2, 2), (2, -2), (2, 2))) / 8
+    peaks &= ring < 0.5 * core
+    # Roundness, only at the peaks
+    ys, xs = np.nonzero(peaks)
+    if len(ys) == 0:
+        return 0, 0
+    ys, xs = ys + r, xs + r
+    pairs = np.stack([residual[ys, xs - 1] + residual[ys, xs + 1], residual[ys - 1, xs] + residual[ys + 1, xs],
+                      residual[ys - 1, xs - 1] + residual[ys + 1, xs + 1], residual[ys - 1, xs + 1] + residual[ys + 1, xs - 1]])
+    elongation = (pairs.max(axis=0) - pairs.min(axis=0)) / (2 * np.maximum(residual[ys, xs], 1e-6))
+    return int(np.count_nonzero(elongation <= ROUND_MAX_ELONGATION)), len(ys)
+
+
+def measure(data):
+    """Background statistics, saturation and point-source count of a grayscale array."""
+    median = float(np.median(data))
+    counts = np.bincount(data.astype(np.uint8).ravel(), minlength=256)
+    mode = int(np.argmax(counts))
+
+    residual = data - block_background(data)
+    mad = float(np.median(np.abs(residual - np.median(residual))))
+    # 8-bit quantization puts a floor on the measurable noise
+    sigma = max(1.4826 * mad, 0.5)
+    sources, peaks = count_point_sources(residual, DETECTION_SIGMA * sigma)
+
+    return {
+        "width": data.shape[1],
+        "height": data.shape[0],
+        "background": median,
+        "sigma": sigma,
+        "range": float(np.percentile(data, 99.5) - np.percentile(data, 0.5)),
+        "saturated": float(np.count_nonzero(data >= SATURATION_LEVEL)) / data.size,
+        "flat": float(counts[mode]) / data.size,
+        "flat_value": mode,
+        "sources": sources,
+        "peaks": peaks,
+    }
+
+
+def judge(stats):
+    if stats["range"] < BLANK_RANGE:
+        return REJECT, "the image looks blank"
+    if stats["flat"] > FLAT_FRACTION:
+        # Mostly one exact color: the noise estimate collapses and text or icons would pass for stars.
+        # Black or white areas can also be a clipped sky or overexposure, which still show round stars
+        graphic_shapes = stats["peaks"] >= MIN_SOURCES and stats["sources"] < MIN_ROUND_FRACTION * stats["peaks"]
+        if FLAT_MIN_VALUE < stats["flat_value"] < SATURATION_LEVEL or graphic_shapes:
+            return REJECT, "the image looks like a screenshot or a graphic"
+    if stats["sources"] < MIN_SOURCES:
+        if stats["saturated"] > MAX_SATURATED:
+            return REJECT, "the image is overexposed, no stars were detected"
+        return REJECT, "no stars were detected"
+    if stats["saturated"] > MAX_SATURATED:
+        return DOUBTFUL, "the image is largely overexposed"
+    if stats["sources"] < FEW_SOURCES:
+        return DOUBTFUL, f"only {stats['sources']} stars detected"
+    if stats["background"] > BRIGHT_BACKGROUND:
+        return DOUBTFUL, "the background is very bright"
+    return OK, f"{stats['sources']} stars detected"